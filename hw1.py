@@ -1,46 +1,367 @@
+import asyncio
+import functools
 import json
+import os
 import re
+import socket
+import sqlite3
+import sys
 import time
-import subprocess
 import argparse
-from typing import Dict, Any, List
-from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 TIMEOUT = 30
-SLEEP = 0.5
-THREADS = 5
+SLEEP = 0.5  # Minimum spacing between queries to the same WHOIS server
+RETRIES = 3
+BACKOFF = 1.0
+DEFAULT_CONCURRENCY = 500
+WHOIS_PORT = 43
+IANA_SERVER = "whois.iana.org"
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30)  # Linux 4.11+
+CACHE_TTL = 60 * 60
+DNS_TTL = 5 * 60
+DB_PATH = os.path.expanduser("~/.whois_cache.sqlite")
+DB_TTL = 30 * 24 * 60 * 60
+DB_FLUSH_ROWS = 500
+
+
+def concurrency_from_env() -> int:
+    value = os.environ.get("WHOIS_CONCURRENCY")
+    if value is None:
+        return DEFAULT_CONCURRENCY
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(
+            f"Ignoring WHOIS_CONCURRENCY={value!r}: not an integer, "
+            f"using {DEFAULT_CONCURRENCY}",
+            file=sys.stderr,
+        )
+        return DEFAULT_CONCURRENCY
+
+
+# Cap on WHOIS queries (connections or whois processes) in flight across all
+# servers. Lookups are almost entirely waiting on the network, so allow many;
+# each server's Limiter still paces the queries it receives, so one server
+# contributes about (query latency / SLEEP) queries in flight and the cap
+# only binds for large batches spread over many or slow servers.
+CONCURRENCY = concurrency_from_env()
+
+# WHOIS servers for common TLDs (the whois-servers.net mapping). Servers for
+# other TLDs are learned from IANA, falling back to <tld>.whois-servers.net.
+WHOIS_SERVERS = {
+    "com": "whois.verisign-grs.com",
+    "net": "whois.verisign-grs.com",
+    "org": "whois.pir.org",
+    "info": "whois.nic.info",
+    "biz": "whois.nic.biz",
+    "io": "whois.nic.io",
+    "co": "whois.nic.co",
+    "ai": "whois.nic.ai",
+    "me": "whois.nic.me",
+    "tv": "whois.nic.tv",
+    "cc": "ccwhois.verisign-grs.com",
+    "us": "whois.nic.us",
+    "edu": "whois.educause.edu",
+    "gov": "whois.dotgov.gov",
+    "app": "whois.nic.google",
+    "dev": "whois.nic.google",
+    "uk": "whois.nic.uk",
+    "de": "whois.denic.de",
+    "fr": "whois.nic.fr",
+    "nl": "whois.domain-registry.nl",
+    "eu": "whois.eu",
+    "ca": "whois.cira.ca",
+    "au": "whois.auda.org.au",
+    "jp": "whois.jprs.jp",
+    "cn": "whois.cnnic.cn",
+    "ru": "whois.tcinet.ru",
+    "br": "whois.registro.br",
+    "in": "whois.registry.in",
+}
+
+# TLD -> WHOIS server learned from IANA
+_TLD_SERVERS: Dict[str, str] = {}
+# TLD -> IANA query, kept so each TLD is only looked up once
+_TLD_DISCOVERY: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+
+# Registrable domain -> (fetch time, registrar)
+_WHOIS_CACHE: Dict[str, Tuple[float, str]] = {}
+# Registrable domain -> lookup currently in progress
+_WHOIS_INFLIGHT: Dict[str, "asyncio.Future[str]"] = {}
+# WHOIS server hostname -> (resolve time, getaddrinfo results)
+_DNS_CACHE: Dict[str, Tuple[float, List[Tuple[Any, ...]]]] = {}
+# Persistent cache shared across runs, opened by main() unless --no-cache
+_DB: Optional[sqlite3.Connection] = None
+# Rows waiting to be written to _DB as (domain, registrar, fetched_at)
+_DB_PENDING: List[Tuple[str, str, int]] = []
+# Shell out to the whois binary instead of querying servers directly
+_USE_SYSTEM_WHOIS = False
+# (event loop, semaphore) bounding queries in flight to CONCURRENCY
+_QUERY_SLOTS: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+_NORMALIZE_RE = re.compile(r"^(?:https?://)?(?:www\.)?")
+_SERVICE_SUBDOMAINS = frozenset({"www", "mail", "ftp", "blog", "shop"})
+_KV_RE = re.compile(
+    r"(?m)^(?![%#])[ \t]*([^:\s][^:\r\n]*?)[ \t]*:[ \t]*(.*?)[ \t\r]*$"
+)
+
+# Registrar field names in order of preference
+REGISTRAR_FIELDS = [
+    "registrar",
+    "registrar name",
+    "sponsoring registrar",
+    "registrar organization",
+    "registrant organization",
+    "registrant",
+]
+_REGISTRAR_RANKS = {field: rank for rank, field in enumerate(REGISTRAR_FIELDS)}
+_REGISTRAR_RE = re.compile(
+    r"(?im)^[ \t]*(%s)[ \t]*:[ \t]*(\S.*?)[ \t\r]*$"
+    % "|".join(map(re.escape, REGISTRAR_FIELDS))
+)
+
+# Fields naming the WHOIS server that holds the full record
+REFERRAL_FIELDS = [
+    "registrar whois server",
+    "whois server",
+    "referralserver",
+    "refer",
+    "whois",
+]
+_SCHEME_RE = re.compile(r"^[a-z]+://")
+
+# Responses servers send instead of data when a client queries too fast
+_RATE_LIMITED_RE = re.compile(
+    r"(?i)limit exceeded|exceeded (?:the )?(?:query |rate )?limit|has been exceeded"
+    r"|limit reached|\bquota\b|too many (?:requests|queries)"
+)
+
+
+class Limiter:
+    # Allows at most `calls` acquisitions per `period` seconds by handing out
+    # evenly spaced start times. Each caller books the next free slot and
+    # sleeps only until it arrives, so waiters never queue on a lock.
+    def __init__(self, calls: int, period: float) -> None:
+        self.interval = period / calls
+        self.next_slot = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+# WHOIS server -> rate limiter; rate limits are per server, not global
+_LIMITERS: Dict[str, Limiter] = {}
+
 
+def limiter_for_server(server: str) -> Limiter:
+    limiter = _LIMITERS.get(server)
+    if limiter is None:
+        limiter = _LIMITERS[server] = Limiter(1, SLEEP)
+    return limiter
 
-def lookup(domain: str) -> Dict[str, Any]:
+
+@functools.lru_cache(maxsize=100_000)
+def tld_of(domain: str) -> str:
+    return domain.rstrip(".").rsplit(".", 1)[-1]
+
+
+def server_for_domain(domain: str) -> Optional[str]:
+    # Known or previously learned server for the domain's TLD, if any
+    tld = tld_of(domain)
+    return WHOIS_SERVERS.get(tld) or _TLD_SERVERS.get(tld)
+
+
+async def discover_server(tld: str) -> str:
+    # Ask IANA once per TLD and remember the answer, so later domains under
+    # the same TLD go straight to its server without the extra round trip
+    task = _TLD_DISCOVERY.get(tld)
+    if task is None:
+        task = _TLD_DISCOVERY[tld] = asyncio.ensure_future(lookup(tld, IANA_SERVER))
+    result = await asyncio.shield(task)
+    if "data" not in result and _TLD_DISCOVERY.get(tld) is task:
+        # Let the next domain under this TLD ask IANA again
+        del _TLD_DISCOVERY[tld]
+    server = "data" in result and parse(result["data"]).get("whois")
+    if not server:
+        return f"{tld}.whois-servers.net"
+    _TLD_SERVERS[tld] = server
+    return server
+
+
+async def resolve(host: str) -> List[Tuple[Any, ...]]:
+    # A batch talks to a few dozen WHOIS servers at most, so resolve each
+    # hostname once per DNS_TTL rather than once per query
+    cached = _DNS_CACHE.get(host)
+    if cached is not None and time.monotonic() - cached[0] < DNS_TTL:
+        return cached[1]
+    loop = asyncio.get_running_loop()
+    addresses = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    _DNS_CACHE[host] = (time.monotonic(), addresses)
+    return addresses
+
+
+async def connect(family: int, type_: int, proto: int, address: Any) -> socket.socket:
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, type_, proto)
     try:
-        result = subprocess.run(
-            ["whois", domain], capture_output=True, text=True, timeout=TIMEOUT
+        # WHOIS servers close the connection after every answer, so there is
+        # nothing to pool; TCP Fast Open instead lets repeat connections to
+        # the same server carry the query in the SYN
+        if sys.platform.startswith("linux"):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+            except OSError:
+                pass
+        sock.setblocking(False)
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def query(server: str, domain: str) -> str:
+    # Registries only match internationalised domains in ACE (punycode) form
+    try:
+        request = domain.encode("idna")
+    except UnicodeError:
+        request = domain.encode()
+    error: Optional[OSError] = None
+    # Try each resolved address in turn, so a broken IPv6 route falls back
+    # to IPv4 the way asyncio.open_connection() does. The whole exchange is
+    # inside the loop: with a cached Fast Open cookie connect() succeeds
+    # without sending anything, so a dead address only fails on write/read.
+    for family, type_, proto, _, address in await resolve(server):
+        # Connect to the resolved IP directly; IPv6 addresses carry extra fields
+        address = (address[0], WHOIS_PORT, *address[2:])
+        try:
+            sock = await connect(family, type_, proto, address)
+            reader, writer = await asyncio.open_connection(sock=sock)
+            try:
+                # RFC 3912: send the query terminated by CRLF, the server
+                # answers and closes the connection.
+                writer.write(request + b"\r\n")
+                await writer.drain()
+                response = await reader.read()
+            finally:
+                writer.close()
+        except OSError as e:
+            error = e
+            continue
+        return response.decode("utf-8", errors="replace")
+    raise error or OSError(f"No addresses found for {server}")
+
+
+async def run_whois(domain: str) -> Dict[str, Any]:
+    # Spawn the whois binary without blocking the event loop, so many
+    # processes can run at once with their pipes multiplexed by the loop
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "whois",
+            domain,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
-        if result.returncode != 0:
-            return {"error": "WHOIS command failed", "stderr": result.stderr}
-        return {"data": result.stdout}
-    except Exception as e:
+    except OSError as e:
         return {"error": f"Lookup failed: {str(e)}"}
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return {"error": "Lookup failed: timed out"}
+    if process.returncode != 0:
+        return {
+            "error": "WHOIS command failed",
+            "stderr": stderr.decode("utf-8", errors="replace"),
+        }
+    return {"data": stdout.decode("utf-8", errors="replace")}
+
+
+def query_slots() -> asyncio.Semaphore:
+    # Semaphores belong to one event loop, so make a new one per loop
+    global _QUERY_SLOTS
+    loop = asyncio.get_running_loop()
+    if _QUERY_SLOTS is None or _QUERY_SLOTS[0] is not loop:
+        _QUERY_SLOTS = (loop, asyncio.Semaphore(CONCURRENCY))
+    return _QUERY_SLOTS[1]
+
+
+async def lookup(domain: str, server: Optional[str] = None) -> Dict[str, Any]:
+    if _USE_SYSTEM_WHOIS:
+        server = server_for_domain(domain) or tld_of(domain)
+        await limiter_for_server(server).acquire()
+        async with query_slots():
+            return await run_whois(domain)
+    if server is None:
+        server = server_for_domain(domain) or await discover_server(tld_of(domain))
+    limiter = limiter_for_server(server)
+    for attempt in range(RETRIES + 1):
+        await limiter.acquire()
+        try:
+            async with query_slots():
+                data = await asyncio.wait_for(query(server, domain), timeout=TIMEOUT)
+        except asyncio.TimeoutError:
+            return {"error": "Lookup failed: timed out"}
+        except (ConnectionRefusedError, ConnectionResetError) as e:
+            result = {"error": f"Lookup failed: {str(e)}"}
+        except Exception as e:
+            # DNS failures and the like will not go away by retrying
+            return {"error": f"Lookup failed: {str(e)}"}
+        else:
+            if not _RATE_LIMITED_RE.search(data):
+                return {"data": data}
+            result = {"error": "Lookup failed: rate limited"}
+        # Back off exponentially before retrying a refused or throttled query
+        if attempt < RETRIES:
+            await asyncio.sleep(BACKOFF * 2**attempt)
+    return result
 
 
-def load_domains_from_file(filename: str) -> List[str]:
+def load_domains_from_file(filename: str) -> Iterator[str]:
     with open(filename, "r") as file:
-        lines = file.readlines()
-        # Strip whitespace and filter out comments and blank lines
-        domains = []
-        for line in lines:
+        # Stream the file line by line instead of reading it all into memory
+        for line in file:
             line = line.strip()  # Remove leading/trailing whitespace including newlines
             # Skip empty lines and comments
             if line and not line.startswith("#"):
                 # Handle multiple domains per line (space-separated)
-                line_domains = line.split()
-                domains.extend(line_domains)
-    return domains
+                yield from line.split()
 
 
-def handle_input() -> List[str]:
+def handle_input() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Lookup WHOIS data for domains")
     parser.add_argument("--file", "-f", help="File containing domains")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Ignore and do not update the cache in {DB_PATH}",
+    )
+    parser.add_argument(
+        "--system-whois",
+        action="store_true",
+        help="Run the system whois command instead of querying servers directly",
+    )
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Print each result as a JSON line as soon as it is available",
+    )
     parser.add_argument(
         "domains", nargs="*", help="Space-separated domain names to lookup"
     )
@@ -49,67 +370,272 @@ def handle_input() -> List[str]:
         parser.print_help()
         exit(1)
     if args.file:
-        return load_domains_from_file(args.file)
-    return args.domains
+        args.domains = load_domains_from_file(args.file)
+    return args
+
+
+def parse(data: str) -> Dict[str, str]:
+    # Tokenize every "key: value" line in one pass, skipping % and # comments.
+    # Later keys overwrite earlier ones.
+    return {key.lower(): value for key, value in _KV_RE.findall(data)}
+
+
+@functools.lru_cache(maxsize=100_000)
+def extract_registrable_domain(domain: str) -> str:
+    # Remove any protocol and www prefix in one pass to get the base domain
+    normalized_domain = _NORMALIZE_RE.sub("", domain.lower(), count=1)
+    # Drop a common service subdomain (mail.example.com -> example.com)
+    parts = normalized_domain.split(".")
+    if len(parts) > 2 and parts[0] in _SERVICE_SUBDOMAINS:
+        parts = parts[1:]
+    return ".".join(parts)
+
 
+def find_referral(data: Dict[str, str]) -> Optional[str]:
+    for field in REFERRAL_FIELDS:
+        if data.get(field):
+            # Values may look like whois://whois.example.net:43
+            server = _SCHEME_RE.sub("", data[field].lower())
+            return server.split("/", 1)[0].split(":", 1)[0] or None
+    return None
 
-def parse(data: str) -> Dict[str, Any]:
-    data = data.split("\n")
-    data = [item.split(":") for item in data]
-    data = {
-        item[0]: item[1].strip()
-        for item in data
-        if len(item) >= 2
-        and not item[0].startswith("%")
-        and not item[0].startswith("#")
-    }
-    return data
 
+def find_registrar_fast(data: str) -> Optional[str]:
+    # Scan the raw response for registrar fields without parsing every line,
+    # stopping at the first "Registrar:", which is usually near the top
+    best, best_rank = None, len(REGISTRAR_FIELDS)
+    for match in _REGISTRAR_RE.finditer(data):
+        rank = _REGISTRAR_RANKS[match.group(1).lower()]
+        if rank == 0:
+            return match.group(2)
+        if rank < best_rank:
+            best, best_rank = match.group(2), rank
+    return best
 
-def return_registrar(domain: str) -> str:
-    time.sleep(SLEEP)
-    # Remove www prefix and any protocol prefixes to get the base domain
-    normalized_domain = re.sub(r"^(https?://)?www\.", "", domain.lower())
-    # Also remove any trailing protocol prefixes if they exist
-    normalized_domain = re.sub(r"^https?://", "", normalized_domain)
 
-    whois_result = lookup(normalized_domain)
+def clear_cache() -> None:
+    _WHOIS_CACHE.clear()
+    _DNS_CACHE.clear()
 
-    # Check if lookup returned an error
+
+def open_cache(path: str) -> sqlite3.Connection:
+    # Autocommit mode; writes are buffered and flushed in short transactions
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS whois_cache("
+        "domain TEXT PRIMARY KEY, registrar TEXT, fetched_at INTEGER)"
+    )
+    return db
+
+
+def load_cached_registrar(domain: str) -> Optional[str]:
+    if _DB is None:
+        return None
+    # A cache problem (locked, corrupt, ...) must never fail the lookup itself
+    try:
+        row = _DB.execute(
+            "SELECT registrar, fetched_at FROM whois_cache WHERE domain = ?",
+            (domain,),
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None or time.time() - row[1] >= DB_TTL:
+        return None
+    return row[0]
+
+
+def store_cached_registrar(domain: str, registrar: str, fetched_at: float) -> None:
+    if _DB is not None:
+        _DB_PENDING.append((domain, registrar, int(fetched_at)))
+        if len(_DB_PENDING) >= DB_FLUSH_ROWS:
+            flush_cache()
+
+
+def flush_cache() -> None:
+    # Write buffered rows in one short transaction, so the write lock is never
+    # held while waiting on the network
+    if _DB is None or not _DB_PENDING:
+        return
+    rows = _DB_PENDING[:]
+    _DB_PENDING.clear()
+    try:
+        _DB.execute("BEGIN IMMEDIATE")
+        _DB.executemany("INSERT OR REPLACE INTO whois_cache VALUES (?, ?, ?)", rows)
+        _DB.execute("COMMIT")
+    except sqlite3.Error:
+        # Losing cache rows is harmless; the next run looks them up again
+        if _DB.in_transaction:
+            _DB.execute("ROLLBACK")
+
+
+async def fetch_registrar(domain: str) -> str:
+    whois_result = await lookup(domain)
+
+    # Check if lookup returned an error; errors are not cached
     if "error" in whois_result:
         return whois_result["error"]
 
-    # Parse the successful WHOIS data
-    data = parse(whois_result["data"])
+    # Parsing stays inline on the event loop: scanning a typical 5-10 KB
+    # response takes ~0.1 ms, against 100+ ms of network wait per query and
+    # SLEEP seconds between queries to one server. Handing responses to a
+    # process pool only pays off once parsing nears the network time per
+    # query (multi-megabyte responses), which WHOIS servers do not send.
+    # Only fully parse the response when no registrar field is present
+    registrar = find_registrar_fast(whois_result["data"])
+    if registrar is None and not _USE_SYSTEM_WHOIS:
+        # Thin registries only point at the server holding the full record;
+        # the system whois command follows these referrals by itself
+        referral = find_referral(parse(whois_result["data"]))
+        if referral and referral != server_for_domain(domain):
+            referral_result = await lookup(domain, referral)
+            if "error" in referral_result:
+                return referral_result["error"]
+            registrar = find_registrar_fast(referral_result["data"])
+    fetched_at = time.time()
+    if registrar is None:
+        # A reply without a registrar may be an unrecognised throttle or quota
+        # message, so keep it for this run only and never persist it
+        _WHOIS_CACHE[domain] = (fetched_at, "Not found")
+        return "Not found"
+    _WHOIS_CACHE[domain] = (fetched_at, registrar)
+    store_cached_registrar(domain, registrar, fetched_at)
+    return registrar
 
-    # Convert all keys to lowercase for easier matching
-    data_lower = {key.lower(): value for key, value in data.items()}
 
-    # Try different possible registrar field names in order of preference
-    registrar_fields = [
-        "registrar",
-        "registrar name",
-        "sponsoring registrar",
-        "registrar organization",
-        "registrant organization",
-        "registrant",
-    ]
+async def registrar_for_registrable_domain(key: str) -> str:
+    cached = _WHOIS_CACHE.get(key)
+    if cached is not None and time.time() - cached[0] < CACHE_TTL:
+        return cached[1]
+    registrar = load_cached_registrar(key)
+    if registrar is not None:
+        _WHOIS_CACHE[key] = (time.time(), registrar)
+        return registrar
 
-    for field in registrar_fields:
-        if field in data_lower and data_lower[field]:
-            return data_lower[field]
-    return "Not found"
+    # Coalesce concurrent requests for the same domain into one lookup
+    task = _WHOIS_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_registrar(key))
+        _WHOIS_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _WHOIS_INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
 
 
-def return_registrars(domains: List[str]) -> Dict[str, str]:
-    with ThreadPoolExecutor(max_workers=THREADS) as executor:
-        registrars = list(executor.map(return_registrar, domains))
-        result = {domain: registrar for domain, registrar in zip(domains, registrars)}
-    return result
+async def return_registrar(domain: str) -> str:
+    return await registrar_for_registrable_domain(extract_registrable_domain(domain))
+
+
+async def return_registrars(
+    domains: Iterable[str], on_result: Optional[Callable[[str, str], None]] = None
+) -> Dict[str, str]:
+    # Input domain -> registrable domain, in input order
+    registrable: Dict[str, str] = {}
+    # Registrable domain -> registrar
+    registrars: Dict[str, str] = {}
+    # Registrable domain -> input domains that share it
+    inputs: Dict[str, List[str]] = {}
+
+    async def worker(pending: Iterator[str]) -> None:
+        for key in pending:
+            registrars[key] = await registrar_for_registrable_domain(key)
+            # Report each result as soon as it lands rather than after the batch
+            if on_result is not None:
+                for domain in inputs[key]:
+                    on_result(domain, registrars[key])
+
+    # Look up each registrable domain once (www.example.com and example.com
+    # share a lookup), queued per WHOIS server so a slow server only delays
+    # its own domains instead of blocking lookups against every other server.
+    # The domains are only iterated once.
+    queues: Dict[str, List[str]] = {}
+    for domain in domains:
+        if domain in registrable:
+            continue
+        key = registrable[domain] = extract_registrable_domain(domain)
+        inputs.setdefault(key, []).append(domain)
+        if key in registrars:
+            continue
+        registrars[key] = ""
+        # TLDs whose server is not known yet are queued together by TLD
+        server = server_for_domain(key) or tld_of(key)
+        queues.setdefault(server, []).append(key)
+    # Give each server enough workers to keep its Limiter's slots filled; the
+    # Limiter paces them and query_slots() caps queries in flight overall
+    workers = []
+    for server_domains in queues.values():
+        pending = iter(server_domains)
+        count = min(len(server_domains), CONCURRENCY)
+        workers.extend(worker(pending) for _ in range(count))
+
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        flush_cache()
+    return {domain: registrars[key] for domain, key in registrable.items()}
+
+
+def use_pidfd_child_watcher() -> None:
+    # Before Python 3.12, asyncio waits on every child process from a thread
+    # of its own. Watching pidfds instead lets the event loop reap the whois
+    # children through the same epoll set that multiplexes their pipes, so
+    # running CONCURRENCY children costs no extra threads. Python 3.12+ and
+    # uvloop already work this way.
+    if uvloop is not None or sys.version_info >= (3, 12):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return  # Not Linux 5.3+
+    watcher = asyncio.PidfdChildWatcher()
+    watcher.attach_loop(asyncio.get_running_loop())
+    asyncio.set_child_watcher(watcher)
+
+
+def print_results(result: Dict[str, str]) -> None:
+    if orjson is not None:
+        output = orjson.dumps(result)
+    else:
+        # Same compact UTF-8 bytes as orjson, whichever is installed
+        output = json.dumps(
+            result, ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+    sys.stdout.buffer.write(output + b"\n")
+    sys.stdout.flush()
+
+
+def print_result(domain: str, registrar: str) -> None:
+    print_results({domain: registrar})
+
+
+async def main() -> None:
+    global _DB, _USE_SYSTEM_WHOIS
+    args = handle_input()
+    _USE_SYSTEM_WHOIS = args.system_whois
+    if _USE_SYSTEM_WHOIS:
+        use_pidfd_child_watcher()
+    if not args.no_cache:
+        try:
+            _DB = open_cache(DB_PATH)
+        except sqlite3.Error:
+            _DB = None  # Run without the persistent cache
+    try:
+        if args.ndjson:
+            # One {"domain": "registrar"} object per line, in completion order
+            await return_registrars(args.domains, print_result)
+        else:
+            print_results(await return_registrars(args.domains))
+    finally:
+        if _DB is not None:
+            _DB.close()
+            _DB = None
 
 
 if __name__ == "__main__":
-    domains = handle_input()
-    result = return_registrars(domains)
-    result_json = json.dumps(result)
-    print(result_json)
+    run = asyncio.run
+    if uvloop is not None:
+        if hasattr(uvloop, "run"):
+            run = uvloop.run  # uvloop >= 0.18, where install() is deprecated
+        else:
+            uvloop.install()
+    run(main())